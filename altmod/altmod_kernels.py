@@ -0,0 +1,187 @@
+import math
+
+import numpy as np
+
+# Numba is optional: when it is not installed, the kernels fall back to NumPy
+# implementations returning the same results.
+try:
+    from numba import njit, prange, set_num_threads
+    has_numba = True
+except ImportError:
+    has_numba = False
+
+
+# Integer codes for the atom types engaged in HDDRs. All the side chain atoms
+# share the "other" code.
+atom_type_codes = {"CA": 0, "N": 1, "C": 2, "O": 3, "OXT": 4}
+other_atom_type_code = 5
+
+main_chain_atoms = frozenset(("CA", "N", "C", "O", "OXT"))
+
+# Bitset storing for each atom type code if it is a main chain atom.
+main_chain_bits = 0
+for _atom_type in main_chain_atoms:
+    main_chain_bits |= 1 << atom_type_codes[_atom_type]
+
+def is_main_chain_code(atom_type_code):
+    return (main_chain_bits >> atom_type_code) & 1 == 1
+
+def get_atom_type_code(atom_type):
+    return atom_type_codes.get(atom_type, other_atom_type_code)
+
+def _get_hddr_group_code(atom_type_code_1, atom_type_code_2):
+    """
+    Assigns the MODELLER code for the type of restraint acting between two atoms.
+    """
+    if atom_type_code_1 == atom_type_codes["CA"] and atom_type_code_2 == atom_type_codes["CA"]:
+        return 9
+    elif set((atom_type_code_1, atom_type_code_2)) == set((atom_type_codes["N"], atom_type_codes["O"])):
+        return 10
+    elif is_main_chain_code(atom_type_code_1) or is_main_chain_code(atom_type_code_2):
+        return 23
+    else:
+        return 26
+
+# Lookup table storing the MODELLER code for the type of restraint of each couple
+# of atom type codes.
+hddr_group_table = np.empty((other_atom_type_code+1, other_atom_type_code+1), dtype=np.int8)
+for _code_1 in range(other_atom_type_code+1):
+    for _code_2 in range(other_atom_type_code+1):
+        hddr_group_table[_code_1, _code_2] = _get_hddr_group_code(_code_1, _code_2)
+
+
+def _score_pairs_loop(tem_coords, tem_mask, tem_row_i, tem_row_j,
+                      tar_coords, tar_mask, tar_row_i, tar_row_j,
+                      slot_i, slot_j, t1, t2, grp_table):
+    """
+    Computes the template distances (dt), the target distances (dn) and the
+    delta_d values (dd) of a series of atom pairs, along with the MODELLER
+    code of the HDDR group of each pair. The coordinates are read directly from
+    the template and target coordinates arrays, and all the values of a pair
+    are computed in a single pass.
+
+    # Arguments
+        tem_coords, tar_coords: (N_res, N_slots, 3) arrays with the coordinates
+            of the template and target atoms. The distances are returned with
+            the same dtype of these arrays.
+        tem_mask, tar_mask: (N_res, N_slots) boolean arrays storing which atoms
+            are present in the template and target residues.
+        tem_row_i, tem_row_j, tar_row_i, tar_row_j: (N,) arrays with the indices
+            of the template and target residues of the pairs.
+        slot_i, slot_j: (N,) arrays with the slots of the atoms of the pairs.
+        t1, t2: (N,) int8 arrays with the atom type codes of the pairs.
+        grp_table: table with the HDDR group code of each couple of atom type
+            codes (see 'hddr_group_table').
+
+    # Returns
+        The dt, dn, dd and group code arrays, along with a boolean array storing
+        which pairs have all their atoms in the template and target (the values
+        of the other pairs are meaningless).
+    """
+    n = t1.shape[0]
+    dt = np.empty(n, tem_coords.dtype)
+    dn = np.empty(n, tem_coords.dtype)
+    dd = np.empty(n, tem_coords.dtype)
+    grp = np.empty(n, np.int8)
+    found = np.empty(n, np.bool_)
+    for p in prange(n):
+        ti = tem_row_i[p]
+        tj = tem_row_j[p]
+        ri = tar_row_i[p]
+        rj = tar_row_j[p]
+        si = slot_i[p]
+        sj = slot_j[p]
+        found[p] = tem_mask[ti, si] and tem_mask[tj, sj] and tar_mask[ri, si] and tar_mask[rj, sj]
+        if not found[p]:
+            dt[p] = 0.0
+            dn[p] = 0.0
+            dd[p] = 0.0
+            grp[p] = 0
+            continue
+        # Template distance.
+        dx = tem_coords[ti, si, 0]-tem_coords[tj, sj, 0]
+        dy = tem_coords[ti, si, 1]-tem_coords[tj, sj, 1]
+        dz = tem_coords[ti, si, 2]-tem_coords[tj, sj, 2]
+        dt[p] = math.sqrt(dx*dx+dy*dy+dz*dz)
+        # Target distance.
+        dx = tar_coords[ri, si, 0]-tar_coords[rj, sj, 0]
+        dy = tar_coords[ri, si, 1]-tar_coords[rj, sj, 1]
+        dz = tar_coords[ri, si, 2]-tar_coords[rj, sj, 2]
+        dn[p] = math.sqrt(dx*dx+dy*dy+dz*dz)
+        dd[p] = dn[p]-dt[p]
+        # MODELLER code for the type of restraint.
+        grp[p] = grp_table[t1[p], t2[p]]
+    return dt, dn, dd, grp, found
+
+
+def _score_pairs_numpy(tem_coords, tem_mask, tem_row_i, tem_row_j,
+                       tar_coords, tar_mask, tar_row_i, tar_row_j,
+                       slot_i, slot_j, t1, t2, grp_table):
+    """
+    NumPy version of '_score_pairs_loop', used when Numba is not available.
+    """
+    found = (tem_mask[tem_row_i, slot_i] & tem_mask[tem_row_j, slot_j] &
+             tar_mask[tar_row_i, slot_i] & tar_mask[tar_row_j, slot_j])
+    dt = np.sqrt(((tem_coords[tem_row_i, slot_i]-tem_coords[tem_row_j, slot_j])**2).sum(axis=1))
+    dn = np.sqrt(((tar_coords[tar_row_i, slot_i]-tar_coords[tar_row_j, slot_j])**2).sum(axis=1))
+    dd = dn-dt
+    grp = grp_table[t1, t2]
+    return dt, dn, dd, grp, found
+
+
+def _template_distances_loop(coords, mask, atoms_i, atoms_j):
+    """
+    Computes the distances between a series of pairs of template atoms.
+
+    # Arguments
+        coords: (N_atoms, 3) array with the coordinates of the template atoms
+            equivalent to the model atoms (indexed by model atom serial number).
+            The distances are returned with the same dtype of this array.
+        mask: (N_atoms, ) boolean array storing which model atoms have an
+            equivalent atom in the template.
+        atoms_i, atoms_j: (N,) arrays with the model atom serial numbers of the
+            pairs.
+
+    # Returns
+        An array with the distances of the pairs (NaN for pairs in which some
+        atom does not have an equivalent atom in the template).
+    """
+    n = atoms_i.shape[0]
+    out = np.empty(n, coords.dtype)
+    for p in prange(n):
+        i = atoms_i[p]
+        j = atoms_j[p]
+        if mask[i] and mask[j]:
+            dx = coords[i, 0]-coords[j, 0]
+            dy = coords[i, 1]-coords[j, 1]
+            dz = coords[i, 2]-coords[j, 2]
+            out[p] = math.sqrt(dx*dx+dy*dy+dz*dz)
+        else:
+            out[p] = np.nan
+    return out
+
+
+def _template_distances_numpy(coords, mask, atoms_i, atoms_j):
+    """
+    NumPy version of '_template_distances_loop', used when Numba is not available.
+    """
+    out = np.sqrt(((coords[atoms_i]-coords[atoms_j])**2).sum(axis=1))
+    out[~(mask[atoms_i] & mask[atoms_j])] = np.nan
+    return out
+
+
+def limit_kernel_threads(n_threads):
+    """
+    Sets the number of threads used by the parallel kernels of this module (only
+    when they are compiled with Numba).
+    """
+    if has_numba:
+        set_num_threads(n_threads)
+
+
+if has_numba:
+    score_pairs = njit(parallel=True, fastmath=True, cache=True)(_score_pairs_loop)
+    template_distances = njit(parallel=True, fastmath=True, cache=True)(_template_distances_loop)
+else:
+    score_pairs = _score_pairs_numpy
+    template_distances = _template_distances_numpy
@@ -14,6 +14,9 @@ def get_modeller_dist(modeller_atm_i, modeller_atm_j):
                      (modeller_atm_i.y-modeller_atm_j.y)**2 +
                      (modeller_atm_i.z-modeller_atm_j.z)**2)
 
+def get_modeller_coords(modeller_atm):
+    return (modeller_atm.x, modeller_atm.y, modeller_atm.z)
+
 def get_modeller_atom(modeller_residue, atom_type):
     if atom_type in modeller_residue.atoms:
         return modeller_residue.atoms[atom_type]
@@ -2,11 +2,14 @@ from __future__ import print_function
 import csv
 import time
 
+import numpy as np
+
 from modeller import physical, group_restraints
 from modeller import alignment, forms, features
 from modeller.automodel import automodel
 
-from .altmod_utils import hddr_groups, custom_argmin, get_modeller_atom, get_modeller_dist
+from .altmod_utils import hddr_groups, custom_argmin, get_modeller_atom, get_modeller_dist, get_modeller_coords
+from .altmod_kernels import template_distances
 
 
 allowed_mt_weights_schemes = ("uniform",
@@ -191,6 +194,67 @@ class Automodel_custom_restraints(automodel):
             return None
 
 
+    def _initialize_tem_coords(self, template_index):
+        """
+        Builds an array storing, for each atom serial number of the model, the
+        coordinates of the equivalent atom in a template, along with a boolean
+        array storing which model atoms actually have an equivalent atom.
+        """
+
+        if not hasattr(self, "mod_tem_ali_dict_list"):
+            self._initialize_mod_tem_mapping()
+
+        if not hasattr(self, "tem_coords_list"):
+            self.tem_coords_list = [None for i in self.knowns]
+
+        max_atm = max(self.atm_to_res_dict)
+        tem_coords = np.zeros((max_atm+1, 3))
+        tem_mask = np.zeros(max_atm+1, dtype=bool)
+
+        for atm_num, res_num in self.atm_to_res_dict.items():
+            tem_res = self.mod_tem_ali_dict_list[template_index].get(res_num)
+            if tem_res == None:
+                continue
+            tem_atm = get_modeller_atom(tem_res, self.atm_type_dict[atm_num])
+            if tem_atm != None:
+                tem_coords[atm_num] = get_modeller_coords(tem_atm)
+                tem_mask[atm_num] = True
+
+        self.tem_coords_list[template_index] = (tem_coords, tem_mask)
+
+
+    def get_template_distances(self, atoms_1, atoms_2, template_index):
+        """
+        Batch version of the 'get_template_distance' method: given two sequences
+        of atom serial numbers of the model, returns the distances observed in
+        one of the templates between the equivalent atoms of each pair.
+
+        # Arguments
+            atoms_1: sequence (or NumPy array) with the first model atom serial
+                number of each pair.
+            atoms_2: sequence (or NumPy array) with the second model atom serial
+                number of each pair.
+            template_index: numeric index of the template to consider (see the
+                'get_template_distance' method).
+
+        # Returns
+            A NumPy array with the template distances of the pairs. Pairs in
+            which 'atm_1' or 'atm_2' do not have an equivalent atom in the
+            template have a 'nan' value.
+        """
+
+        if not hasattr(self, "atm_to_res_dict"):
+            raise ValueError("Use the 'build_initial_files' or 'homcsr' methods (which will map model residues to the template ones) before using this method.")
+
+        if not hasattr(self, "tem_coords_list") or self.tem_coords_list[template_index] is None:
+            self._initialize_tem_coords(template_index)
+
+        tem_coords, tem_mask = self.tem_coords_list[template_index]
+        return template_distances(tem_coords, tem_mask,
+                                  np.asarray(atoms_1, dtype=np.int64),
+                                  np.asarray(atoms_2, dtype=np.int64))
+
+
     def set_custom_hddr_options(self, hddr_params_filepaths,
                                 sigma_col,
                                 location_col=None,
@@ -278,7 +342,7 @@ class Automodel_custom_restraints(automodel):
         if not isinstance(hddr_params_filepaths, list):
             if isinstance(hddr_params_filepaths, tuple):
                 hddr_params_filepaths = list(hddr_params_filepaths)
-            elif isinstance(hddr_params_filepaths, basestring):
+            elif isinstance(hddr_params_filepaths, str):
                 hddr_params_filepaths = [hddr_params_filepaths]
             else:
                 raise TypeError("Invalid type for 'hddr_params_filepaths': %s." % type(hddr_params_filepaths))
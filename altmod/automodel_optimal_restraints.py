@@ -2,12 +2,18 @@ from __future__ import print_function
 import os
 import csv
 import time
+import multiprocessing
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
 
 from modeller import alignment
 from modeller.automodel import automodel
 from modeller.scripts import complete_pdb
 
-from .altmod_utils import get_modeller_atom, get_modeller_dist
+from .altmod_utils import get_modeller_coords
+from .altmod_kernels import score_pairs, get_atom_type_code, hddr_group_table, limit_kernel_threads
 from .automodel_custom_restraints import Automodel_custom_restraints
 
 
@@ -32,6 +38,7 @@ class Automodel_optimal_restraints(Automodel_custom_restraints):
                              target_chain=None,
                              mod_tar_seqid_threshold=0.99,
                              use_target_distances=False,
+                             n_jobs=1,
                             #  max_delta_d_abs_val=6.5,
                             ):
         """
@@ -61,12 +68,19 @@ class Automodel_optimal_restraints(Automodel_custom_restraints):
                 observed in the target experimentally-determined structures are
                 used as location parameters for HDDRs (it would be like modeling
                 having the target structure available as a template).
+            n_jobs: number of processes used to analyse the target-template pairs
+                (each template is analysed independently). By default it is set
+                to 1, and the pairs are analysed in the current process. If set
+                to 'None', the number of CPUs of the machine will be used. Scripts
+                using more than one process must build their models inside an
+                'if __name__ == "__main__":' block.
         """
 
         self.target_filepath = target_filepath
         self.target_chain = target_chain
         self.mod_tar_seqid_threshold = mod_tar_seqid_threshold
         self.use_target_distances = use_target_distances
+        self.n_jobs = n_jobs
         # self.max_delta_d_abs_val = max_delta_d_abs_val
 
 
@@ -150,15 +164,22 @@ class Automodel_optimal_restraints(Automodel_custom_restraints):
             if self.target_chain == None:
                 raise ValueError("The selected target structure has more than chain (%s). In order to extract optimal restraints, provide to the 'set_target_structure' the chain corresponding to the model." % len(modeller_tar_obj.chains))
             modeller_tar_obj = modeller_tar_obj.chains[self.target_chain]
-        tar_seq = "".join([r.code for r in modeller_tar_obj.residues])
-
-        # Check if they are compatible (by aligning them through salign).
-        new_aln = alignment(self.env)
-        new_aln.append_sequence(tar_seq)
-        new_aln.append_sequence(mod_seq)
-        new_aln.salign(gap_penalties_1d=(-900.0, -50.0)) # The as1.sim.mat similarity matrix is used by default.
-        tar_aliseq = "".join([_get_modeller_res_code(p.get_residue(new_aln[0])) for p in new_aln.positions])
-        mod_aliseq = "".join([_get_modeller_res_code(p.get_residue(new_aln[1])) for p in new_aln.positions])
+        # The target residues are retrieved from MODELLER only once.
+        tar_residues = list(modeller_tar_obj.residues)
+        tar_seq = "".join([r.code for r in tar_residues])
+
+        # Check if they are compatible (by aligning them through salign). Identical sequences do
+        # not need to be aligned.
+        if tar_seq == mod_seq:
+            tar_aliseq = tar_seq
+            mod_aliseq = mod_seq
+        else:
+            new_aln = alignment(self.env)
+            new_aln.append_sequence(tar_seq)
+            new_aln.append_sequence(mod_seq)
+            new_aln.salign(gap_penalties_1d=(-900.0, -50.0)) # The as1.sim.mat similarity matrix is used by default.
+            tar_aliseq = _get_aligned_sequence(new_aln, new_aln[0])
+            mod_aliseq = _get_aligned_sequence(new_aln, new_aln[1])
         '''
         import random
         gr = lambda i: i if random.random() > 0.3 else random.choice("QWERTYIPASDFGHKLCVNM" + "-"*5)
@@ -167,13 +188,11 @@ class Automodel_optimal_restraints(Automodel_custom_restraints):
         '''
 
         # Computes the sequence identity between the model and target sequences.
-        matches_count = 0
-        identities_count = 0
-        for mod_p, tar_p in zip(mod_aliseq, tar_aliseq):
-            if mod_p != "-" and tar_p != "-":
-                if mod_p == tar_p:
-                    identities_count += 1
-                matches_count += 1
+        mod_aliseq_array = np.frombuffer(mod_aliseq.encode("ascii"), dtype=np.uint8)
+        tar_aliseq_array = np.frombuffer(tar_aliseq.encode("ascii"), dtype=np.uint8)
+        matches_mask = (mod_aliseq_array != gap_code) & (tar_aliseq_array != gap_code)
+        matches_count = int(matches_mask.sum())
+        identities_count = int(((mod_aliseq_array == tar_aliseq_array) & matches_mask).sum())
         mod_tar_seqid = identities_count/float(matches_count)
 
         # Allows only a small fraction of mismatches.
@@ -181,17 +200,13 @@ class Automodel_optimal_restraints(Automodel_custom_restraints):
             message = "The target and model sequence do not correspond:\n* Tar: %s\n* Mod: %s" % (tar_aliseq, mod_aliseq)
             raise ValueError(message)
 
-        # Find the correspondance between the model and target residues.
-        mod_c = 0
-        tar_c = 0
-        mod_tar_res_dict = {}
-        for mod_pos, tar_pos in zip(mod_aliseq, tar_aliseq):
-            if mod_pos != "-" and tar_pos != "-":
-                mod_tar_res_dict[mod_c] = tar_c
-            if mod_pos != "-":
-                mod_c += 1
-            if tar_pos != "-":
-                tar_c += 1
+        # Find the correspondance between the model and target residues. The array maps the index
+        # of each model residue to the index of the corresponding target residue (-1 for model
+        # residues not present in the target).
+        mod_c = np.cumsum(mod_aliseq_array != gap_code)-1
+        tar_c = np.cumsum(tar_aliseq_array != gap_code)-1
+        tar_row_by_mod_row = np.full(len(mod_seq), -1, dtype=np.int64)
+        tar_row_by_mod_row[mod_c[matches_mask]] = tar_c[matches_mask]
 
 
         #---------------------------------------------
@@ -200,137 +215,73 @@ class Automodel_optimal_restraints(Automodel_custom_restraints):
 
         template_filepaths = self._get_template_filepaths(aln)
 
+        # Get the model residues aligned in each position of the alignment. This is done only
+        # once, since the same model residues are used for all the templates.
+        mod_col, mod_idx = _get_aligned_residues(aln, modeller_mod_seq)
+        mod_code_col = np.array([_get_modeller_res_code(res) for res in mod_col], dtype=object)
+        # Index (starting from 0) of the model residues in each position of the alignment.
+        mod_row_col = np.cumsum(mod_idx != -1)-1
+
+        # Array mapping the serial number of each model atom to its residue number (-1 for
+        # serial numbers not present in the model).
+        res_by_atm = _get_lookup_array(self.atm_to_res_dict)
+
+        # Serial numbers of the atoms engaged in the HDDRs.
+        hddr_pairs = self.hddr_dict["all"]
+        atm_i_array = np.fromiter((pair[0] for pair in hddr_pairs), dtype=np.int64, count=len(hddr_pairs))
+        atm_j_array = np.fromiter((pair[1] for pair in hddr_pairs), dtype=np.int64, count=len(hddr_pairs))
+
+        # Each atom type engaged in HDDRs has a slot in the coordinates arrays of the target and
+        # template residues.
+        atm_type_dict = self.atm_type_dict
+        hddr_atms = np.union1d(atm_i_array, atm_j_array).tolist()
+        slot_types = np.array(sorted(set([atm_type_dict[atm] for atm in hddr_atms])), dtype=object)
+        slot_by_type = dict([(atm_type, slot) for slot, atm_type in enumerate(slot_types)])
+
+        # Get the atom type codes and the slots of the atoms engaged in the HDDRs.
+        type_code_by_atm = _get_lookup_array(dict([(atm, get_atom_type_code(atm_type)) for atm, atm_type in atm_type_dict.items()]))
+        slot_by_atm = _get_lookup_array(dict([(atm, slot_by_type.get(atm_type, -1)) for atm, atm_type in atm_type_dict.items()]))
+        type_i_array = type_code_by_atm[atm_i_array].astype(np.int8)
+        type_j_array = type_code_by_atm[atm_j_array].astype(np.int8)
+        slot_i_array = slot_by_atm[atm_i_array]
+        slot_j_array = slot_by_atm[atm_j_array]
+
+        # Get the coordinates of the target atoms.
+        tar_coords, tar_nums, tar_codes = _get_residues_data(tar_residues, slot_by_type)
+
+        # Extract from the MODELLER objects the data of each template. The target-template pairs
+        # are then analysed independently using only these data.
+        pairs_args = []
         for tem_idx, tem_name in enumerate(self.knowns):
-
-            print("\n* Analysing target-tem_%s (%s) pair." % (tem_idx, tem_name))
-            t1 = time.time()
-
             modeller_tem_seq = aln[tem_name]
-
-            # Get the model-template matches from the 'Alignment' object from MODELLER (here, match
-            # is defined as any couple of aligned residue). Each match is a tuple containing two
-            # 'Residue' objects from MODELLER (the first from the template, the second from the
-            # model).
-            matches = []
-            matches_dict = {}
-            mod_c = 0
-            for pos in aln.positions:
-                mod_pos = pos.get_residue(modeller_mod_seq)
-                tem_pos = pos.get_residue(modeller_tem_seq)
-                if mod_pos != None and tem_pos != None:
-                    matches.append((tem_pos, mod_pos))
-                    matches_dict[mod_pos.index] = (mod_pos, tem_pos)
-                if mod_pos != None:
-                    # Assign an index (starting from 0) to the model residue.
-                    mod_pos._id = mod_c
-                    mod_c += 1
-
-            '''
-            for res in modeller_mod_seq.residues:
-                print res, res.index
-            '''
-
-            # Iterate through the HDDRs found in the MODELLER restraints file.
-            results_list = []
-            for atm_1, atm_2 in self.hddr_dict["all"]:
-
-                # Get atom types of the atoms engaged in the HDDRs.
-                atm_1_type = self.atm_type_dict[atm_1]
-                atm_2_type = self.atm_type_dict[atm_2]
-
-                # Get the model and the equivalent template residues.
-                try:
-                    mod_res_1, tem_res_1 = matches_dict[self.atm_to_res_dict[atm_1]]
-                    mod_res_2, tem_res_2 = matches_dict[self.atm_to_res_dict[atm_2]]
-                except KeyError:
-                    continue
-
-                # Check if the model residue is also present in the target.
-                if not mod_res_1._id in mod_tar_res_dict:
-                    continue
-                if not mod_res_2._id in mod_tar_res_dict:
-                    continue
-
-                # Get the target residues corresponding to the model residues.
-                tar_res_1 = modeller_tar_obj.residues[mod_tar_res_dict[mod_res_1._id]]
-                tar_res_2 = modeller_tar_obj.residues[mod_tar_res_dict[mod_res_2._id]]
-
-                # Get the target and template residues.
-                tem_atm_1 = get_modeller_atom(tem_res_1, atm_1_type)
-                tem_atm_2 = get_modeller_atom(tem_res_2, atm_2_type)
-
-                tar_atm_1 = get_modeller_atom(tar_res_1, atm_1_type)
-                tar_atm_2 = get_modeller_atom(tar_res_2, atm_2_type)
-
-                # Get the interatomic distances between all the heavy atoms of the two template
-                # residues.
-                if tem_atm_1 != None and tem_atm_2 != None:
-                    grp_dt = get_modeller_dist(tem_atm_1, tem_atm_2)
-                # The template residue may have different atoms with respect to the target/model residue.
-                else:
-                    continue
-
-                # Get the iteratomic distances between the target heavy atoms.
-                if tar_atm_1 != None and tar_atm_2 != None:
-                    grp_dn = get_modeller_dist(tar_atm_1, tar_atm_2)
-                else:
-                    continue
-
-                # Assigns the MODELLER code for the type of restraint.
-                if atm_1_type == "CA" and atm_2_type == "CA":
-                    grp_name = "9"
-                elif (atm_1_type == "N" and atm_2_type == "O") or (atm_1_type == "O" and atm_2_type == "N"):
-                    grp_name = "10"
-                else:
-                    if atm_1_type in main_chain_atoms or atm_2_type in main_chain_atoms:
-                        grp_name = "23"
-                    else:
-                        grp_name = "26"
-
-                # Get the delta_d value.
-                grp_dd = grp_dn-grp_dt
-                # if abs(grp_dd) >= self.max_delta_d_abs_val:
-                #     continue
-
-                # Prepare the main columns.
-                pair_results = {"RST_GRP": grp_name,
-                                "GRP_DN": grp_dn,
-                                "GRP_DT": grp_dt,
-                                "GRP_DD": grp_dd,
-                                "MOD_ATOM_TYPE_I": atm_1_type,
-                                "MOD_ATOM_TYPE_J": atm_2_type,
-                                "MOD_ATOM_INDEX_I": atm_1,
-                                "MOD_ATOM_INDEX_J": atm_2,}
-
-                # Prepare additional columns.
-                base_pair_results = {"MOD_RES_PDB_ID_I": mod_res_1.index, "MOD_RES_PDB_ID_J": mod_res_2.index,
-                                     "MOD_RES_NAME_I": mod_res_1.code, "MOD_RES_NAME_J": mod_res_2.code,
-                                     "TAR_RES_PDB_ID_I": tar_res_1.num, "TAR_RES_PDB_ID_J": tar_res_2.num,
-                                     "TAR_RES_NAME_I": tar_res_1.code, "TAR_RES_NAME_J": tar_res_2.code,
-                                     "TEM_RES_PDB_ID_I": tem_res_1.num, "TEM_RES_PDB_ID_J": tem_res_2.num,
-                                     "TEM_RES_NAME_I": tem_res_1.code, "TEM_RES_NAME_J": tem_res_2.code,}
-                pair_results.update(base_pair_results)
-
-                # Add a row in the results .csv file.
-                results_list.append(pair_results)
-
-
-            #-------------------------------------------------------
-            # Writes a results file for each target-template pair. -
-            #-------------------------------------------------------
-
-            t2 = time.time()
-
-            print("- It took %s." % (t2-t1), len(results_list))
+            tem_idx_array = _get_aligned_residues(aln, modeller_tem_seq)[1]
+            tem_coords, tem_nums, tem_codes = _get_residues_data(modeller_tem_seq.residues, slot_by_type)
             analysis_filename = "%s_tar_tem_%s.csv" % (self.sequence, tem_idx)
-            with open(analysis_filename, "w") as c_fh:
-                if len(results_list) != 0:
-                    column_names = list(sorted(results_list[0].keys()))
-                    writer = csv.DictWriter(c_fh, fieldnames=column_names)
-                    writer.writeheader()
-                    for pair_results in results_list:
-                        writer.writerow(pair_results)
-            # Sets the custom HDDR params files of the class.
+            pairs_args.append((tem_idx, tem_name, analysis_filename,
+                               (atm_i_array, atm_j_array, type_i_array, type_j_array,
+                                slot_i_array, slot_j_array, slot_types, res_by_atm),
+                               (mod_idx, mod_row_col, mod_code_col),
+                               (tar_row_by_mod_row, tar_coords, tar_nums, tar_codes),
+                               (tem_idx_array, tem_coords, tem_nums, tem_codes)))
+
+        # Analyse the target-template pairs in parallel.
+        n_jobs = min(self.n_jobs or os.cpu_count() or 1, len(pairs_args))
+        if n_jobs > 1:
+            # The processes only receive NumPy arrays and strings, so they are not forked
+            # from this one (forking after a parallel kernel has run here may deadlock
+            # some threading layers of Numba).
+            if "forkserver" in multiprocessing.get_all_start_methods():
+                mp_context = multiprocessing.get_context("forkserver")
+            else:
+                mp_context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=n_jobs, mp_context=mp_context,
+                                     initializer=_init_pairs_worker) as executor:
+                pairs_results = list(executor.map(_analyse_target_template_pair, *zip(*pairs_args)))
+        else:
+            pairs_results = [_analyse_target_template_pair(*args) for args in pairs_args]
+
+        # Sets the custom HDDR params files of the class.
+        for tem_idx, analysis_filename in pairs_results:
             self.hddr_params_filepaths[tem_idx] = analysis_filename
 
 
@@ -342,7 +293,7 @@ class Automodel_optimal_restraints(Automodel_custom_restraints):
             aln = self.read_alignment()
 
         # Scans each atom directory.
-        atom_dirs_content_list = [os.listdir(adp) for adp in self.env.io.atom_files_directory]
+        atom_dirs_content_list = [set(os.listdir(adp)) for adp in self.env.io.atom_files_directory]
 
         template_filepaths = []
         for tem_idx, tem_seq_obj in enumerate(aln):
@@ -353,13 +304,14 @@ class Automodel_optimal_restraints(Automodel_custom_restraints):
                 template_filepaths.append(tem_seq_obj.atom_file)
                 template_found = True
             else:
+                # Different file names to check.
+                tem_seq_obj_codes = (tem_seq_obj.code,
+                                     tem_seq_obj.code + ".pdb",
+                                     os.path.basename(tem_seq_obj.atom_file),
+                                     os.path.basename(tem_seq_obj.atom_file) + ".pdb")
                 # Checks in each atom directory.
                 for atom_dirpath, atom_dir_content in zip(self.env.io.atom_files_directory, atom_dirs_content_list):
-                    # Checks for different file names.
-                    for tem_seq_obj_code in (tem_seq_obj.code,
-                                             tem_seq_obj.code + ".pdb",
-                                             os.path.basename(tem_seq_obj.atom_file),
-                                             os.path.basename(tem_seq_obj.atom_file) + ".pdb"):
+                    for tem_seq_obj_code in tem_seq_obj_codes:
                         if tem_seq_obj_code in atom_dir_content:
                             template_filepaths.append(os.path.join(atom_dirpath, tem_seq_obj_code))
                             template_found = True
@@ -371,14 +323,215 @@ class Automodel_optimal_restraints(Automodel_custom_restraints):
         return template_filepaths
 
 
+# Columns of the target-template pairs analysis .csv files.
+results_column_names = ("GRP_DD", "GRP_DN", "GRP_DT",
+                        "MOD_ATOM_INDEX_I", "MOD_ATOM_INDEX_J",
+                        "MOD_ATOM_TYPE_I", "MOD_ATOM_TYPE_J",
+                        "MOD_RES_NAME_I", "MOD_RES_NAME_J",
+                        "MOD_RES_PDB_ID_I", "MOD_RES_PDB_ID_J",
+                        "RST_GRP",
+                        "TAR_RES_NAME_I", "TAR_RES_NAME_J",
+                        "TAR_RES_PDB_ID_I", "TAR_RES_PDB_ID_J",
+                        "TEM_RES_NAME_I", "TEM_RES_NAME_J",
+                        "TEM_RES_PDB_ID_I", "TEM_RES_PDB_ID_J")
+# Format of the rows of the target-template pairs analysis .csv files (the
+# distances are written with six decimal places).
+results_row_format = ("%.6f,%.6f,%.6f,"
+                      "%d,%d,"
+                      "%s,%s,"
+                      "%s,%s,"
+                      "%d,%d,"
+                      "%d,"
+                      "%s,%s,"
+                      "%s,%s,"
+                      "%s,%s,"
+                      "%s,%s\n")
+# Number of rows formatted and written at once.
+results_chunk_size = 100000
+
+
 ###############################################################################
 # Functions used only in this module.                                         #
 ###############################################################################
 
+gap_code = ord("-")
+
+def _get_lookup_array(int_dict):
+    """
+    Converts a dictionary with non-negative integer keys and values in an array
+    indexed by the keys (elements not corresponding to any key are set to -1).
+    """
+    lookup_array = np.full(max(int_dict)+1, -1, dtype=np.int64)
+    lookup_array[list(int_dict.keys())] = list(int_dict.values())
+    return lookup_array
+
+def _init_pairs_worker():
+    """
+    Initializes a process analysing target-template pairs. Each process uses a
+    single thread for the kernels, since the pairs are already analysed in
+    parallel by the processes.
+    """
+    limit_kernel_threads(1)
+
+
+def _analyse_target_template_pair(tem_idx, tem_name, analysis_filename,
+                                  hddr_data, mod_data, tar_data, tem_data):
+    """
+    Extracts the delta_d data of a target-template pair and writes them in the
+    'analysis_filename' .csv file. It only uses NumPy arrays extracted from the
+    MODELLER objects, so that it can be run in a separate process.
+    """
+
+    (atm_i_array, atm_j_array, type_i_array, type_j_array,
+     slot_i_array, slot_j_array, slot_types, res_by_atm) = hddr_data
+    mod_idx, mod_row_col, mod_code_col = mod_data
+    tar_row_by_mod_row, tar_coords, tar_nums, tar_codes = tar_data
+    tem_idx_array, tem_coords, tem_nums, tem_codes = tem_data
+
+    print("\n* Analysing target-tem_%s (%s) pair." % (tem_idx, tem_name))
+    t1 = time.time()
+
+    # Get the model-template matches (here, match is defined as any couple of aligned residue).
+    # Each match is defined by the same row of a series of arrays, storing the index and code
+    # of the model residue and the indices of the template and target residues.
+    valid = (mod_idx != -1) & (tem_idx_array != -1)
+    match_mod_idx = mod_idx[valid]
+    match_mod_code = mod_code_col[valid]
+    match_tem_row = (np.cumsum(tem_idx_array != -1)-1)[valid]
+    match_tar_row = tar_row_by_mod_row[mod_row_col[valid]]
+
+    # Map each model atom to the row of the match of its residue (-1 for the atoms of the
+    # model residues not aligned to the template).
+    match_row_by_res = np.full(max(res_by_atm.max(), mod_idx.max())+1, -1, dtype=np.int64)
+    match_row_by_res[match_mod_idx] = np.arange(len(match_mod_idx))
+    match_row_by_atm = np.where(res_by_atm != -1, match_row_by_res[res_by_atm], -1)
+
+    # Keep only the HDDRs in which both model residues are aligned to the template.
+    match_row_i = match_row_by_atm[atm_i_array]
+    match_row_j = match_row_by_atm[atm_j_array]
+    sel = np.flatnonzero((match_row_i != -1) & (match_row_j != -1))
+    match_row_i = match_row_i[sel]
+    match_row_j = match_row_j[sel]
+
+    # Check if the model residues are also present in the target.
+    found = (match_tar_row[match_row_i] != -1) & (match_tar_row[match_row_j] != -1)
+    sel = sel[found]
+    match_row_i = match_row_i[found]
+    match_row_j = match_row_j[found]
+
+    # Get the interatomic distances between the template atoms (grp_dt) and the target
+    # atoms (grp_dn), the delta_d values and the MODELLER codes for the type of restraint
+    # of all the HDDRs at once. The template and target residues may have different atoms
+    # with respect to the model residues: these HDDRs are then discarded.
+    tem_row_i = match_tem_row[match_row_i]
+    tem_row_j = match_tem_row[match_row_j]
+    tar_row_i = match_tar_row[match_row_i]
+    tar_row_j = match_tar_row[match_row_j]
+    (grp_dt_array, grp_dn_array, grp_dd_array,
+     grp_code_array, found) = score_pairs(tem_coords, ~np.isnan(tem_coords[:, :, 0]), tem_row_i, tem_row_j,
+                                          tar_coords, ~np.isnan(tar_coords[:, :, 0]), tar_row_i, tar_row_j,
+                                          slot_i_array[sel], slot_j_array[sel],
+                                          type_i_array[sel], type_j_array[sel],
+                                          hddr_group_table)
+    sel = sel[found]
+    match_row_i = match_row_i[found]
+    match_row_j = match_row_j[found]
+    grp_dt_array = grp_dt_array[found]
+    grp_dn_array = grp_dn_array[found]
+    grp_dd_array = grp_dd_array[found]
+    grp_code_array = grp_code_array[found]
+
+    # Prepare the columns of the results .csv file.
+    tem_row_i = match_tem_row[match_row_i]
+    tem_row_j = match_tem_row[match_row_j]
+    tar_row_i = match_tar_row[match_row_i]
+    tar_row_j = match_tar_row[match_row_j]
+    # Main columns (each column is stored in a typed array).
+    results_columns = {"RST_GRP": grp_code_array,
+                       "GRP_DN": grp_dn_array,
+                       "GRP_DT": grp_dt_array,
+                       "GRP_DD": grp_dd_array,
+                       "MOD_ATOM_TYPE_I": slot_types[slot_i_array[sel]],
+                       "MOD_ATOM_TYPE_J": slot_types[slot_j_array[sel]],
+                       "MOD_ATOM_INDEX_I": atm_i_array[sel],
+                       "MOD_ATOM_INDEX_J": atm_j_array[sel],}
+    # Additional columns.
+    base_results_columns = {"MOD_RES_PDB_ID_I": match_mod_idx[match_row_i], "MOD_RES_PDB_ID_J": match_mod_idx[match_row_j],
+                            "MOD_RES_NAME_I": match_mod_code[match_row_i], "MOD_RES_NAME_J": match_mod_code[match_row_j],
+                            "TAR_RES_PDB_ID_I": tar_nums[tar_row_i], "TAR_RES_PDB_ID_J": tar_nums[tar_row_j],
+                            "TAR_RES_NAME_I": tar_codes[tar_row_i], "TAR_RES_NAME_J": tar_codes[tar_row_j],
+                            "TEM_RES_PDB_ID_I": tem_nums[tem_row_i], "TEM_RES_PDB_ID_J": tem_nums[tem_row_j],
+                            "TEM_RES_NAME_I": tem_codes[tem_row_i], "TEM_RES_NAME_J": tem_codes[tem_row_j],}
+    results_columns.update(base_results_columns)
+    n_results = len(sel)
+
+    # if abs(grp_dd) >= self.max_delta_d_abs_val:
+    #     continue
+
+
+    #-------------------------------------------------------
+    # Writes a results file for each target-template pair. -
+    #-------------------------------------------------------
+
+    t2 = time.time()
+
+    print("- It took %s." % (t2-t1), n_results)
+    with open(analysis_filename, "w", newline="", buffering=1<<20) as c_fh:
+        if n_results != 0:
+            writer = csv.writer(c_fh, lineterminator="\n")
+            writer.writerow(results_column_names)
+            # The rows are generated from the columns while writing the file, and are formatted
+            # directly (no field contains commas or quotes) and written in chunks.
+            results_rows = zip(*[results_columns[c].tolist() for c in results_column_names])
+            for rows_chunk in iter(lambda: list(islice(results_rows, results_chunk_size)), []):
+                c_fh.write("".join([results_row_format % row for row in rows_chunk]))
+
+    return tem_idx, analysis_filename
+
+
+def _get_aligned_residues(aln, modeller_seq):
+    """
+    Returns an object array with the residues of a sequence aligned in each
+    position of an alignment ('None' for gaps) and an array with the indices
+    of these residues (-1 for gaps).
+    """
+    res_col = np.empty(len(aln.positions), dtype=object)
+    for pos_idx, pos in enumerate(aln.positions):
+        res_col[pos_idx] = pos.get_residue(modeller_seq)
+    res_idx = np.array([-1 if res == None else res.index for res in res_col], dtype=np.int64)
+    return res_col, res_idx
+
+def _get_residues_data(modeller_residues, slot_by_type):
+    """
+    Returns a (N_res, N_slots, 3) float32 array with the coordinates of the
+    atoms of a series of residues, where each atom type is stored in the slot
+    defined in 'slot_by_type' (missing atoms have NaN coordinates). Also returns
+    two object arrays with the numbers and codes of the residues.
+    """
+    modeller_residues = list(modeller_residues)
+    coords = np.full((len(modeller_residues), len(slot_by_type), 3), np.nan, dtype=np.float32)
+    res_nums = np.empty(len(modeller_residues), dtype=object)
+    res_codes = np.empty(len(modeller_residues), dtype=object)
+    for res_row, res in enumerate(modeller_residues):
+        for atm in res.atoms:
+            if atm.name in slot_by_type:
+                coords[res_row, slot_by_type[atm.name]] = get_modeller_coords(atm)
+        res_nums[res_row] = res.num
+        res_codes[res_row] = res.code
+    return coords, res_nums, res_codes
+
+def _get_aligned_sequence(aln, modeller_seq):
+    """
+    Returns the string of a sequence in an alignment (with "-" for gaps).
+    """
+    aliseq = bytearray(len(aln.positions))
+    for pos_idx, pos in enumerate(aln.positions):
+        res = pos.get_residue(modeller_seq)
+        aliseq[pos_idx] = gap_code if res == None else ord(res.code)
+    return aliseq.decode("ascii")
+
 def _get_modeller_res_code(modeller_res):
     if modeller_res == None:
         return "-"
     else:
         return modeller_res.code
-
-main_chain_atoms = set(("CA", "N", "C", "O", "OXT"))
@@ -14,168 +14,311 @@
 
 from __future__ import print_function
 import os
-import random
-import csv
+import pickle
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
 
-from modeller import environ, log
+import numpy as np
+
+from modeller import environ, log, info
+import altmod
 from altmod.automodel_custom_restraints import Automodel_custom_restraints
 
 
-# Initialize the MODELLER environment.
-examples_dirpath = os.path.dirname(__file__)
-log.none()
-env = environ()
-env.io.atom_files_directory = [".", examples_dirpath]
-
-
-#----------------------------------------
-# Step 1/5: obtain custom sigma values. -
-#----------------------------------------
-
-# We will start by deriving our sigma values. In MODELLER, by default, sigma
-# values are assigned by the "histogram-based" algorithm of the program [1].
-# To serve as an illustratory purpose, here we will generate new sigma values
-# randomly, but you can use the methods presented in this tutorial to build your
-# own HDDR parameters file with sigma values originating from any algorithm
-# (for example, our group is currently working to develop a machine learning
-# system to estimate optimal sigma values).
-
-# We will be modeling a target protein (UniProtKB: P56406) with one template.
-# Our target has 132 residues. Let's generate a list of 132 random numbers which
-# will serve as a base to build the custom sigma values. For example, these numbers
-# might be some scores that express some kind of "target-template" expected
-# structural divergence that we extract from an external algorithm.
-
-# Generate 132 random floats ranging from 0.05 to 1.0.
-target_seq = "TVTVTYDPSNAPSFQQEIANAAQIWNSSVRNVQLRAGGNADFSYYEGNDSRGSYAQTDGHGRGYIFLDYQQNQQYDSTRVTAHETGHVLGLPDHYQGPCSELMSGGGPGPSCTNPYPNAQERSRVNALWANG"
-residue_scores = [random.uniform(0.05, 1.0) for i in target_seq]
-
-# Our list is 1d, but sigma values are parameters for distance restraints acting
-# between pair of atoms: each distance in an model could potentially have
-# its own sigma value.
-# In this tutorial we will generate the sigma values only for CA-CA (Carbon alpha)
-# distances. Therefore we need a 132x132 matrix in which each element could
-# be used a sigma value for a distance restraint between two CA.
-
-# Let's initialize the matrix.
-sigma_values_matrix = [[None]*len(target_seq) for i in range(0, len(target_seq))]
-
-# In this matrix, each element ij will be just the mean of the values of i and j
-# in the initial 1d array.
-for i, val_i in enumerate(residue_scores):
-    for j, val_j in enumerate(residue_scores):
-        sigma_values_matrix[i][j] = (val_i+val_j)/2.0
-
-
-#-------------------------------------------
-# Step 2/5: obtain custom location values. -
-#-------------------------------------------
-
-# Next we need location parameters for the HDDRs of our model. When performing
-# single-template modeling, providing custom location parameters is optional, but
-# to provide an example, we will see how it can be done. As a reminder, in MODELLER,
-# the location of an HDDR is by default the distance observed in our template.
-# As a source of custom location parameters, we will use the distances observed
-# in our target experimentally-determined structure (PDB ID: 1C7K chain A), perturbed
-# with a small error. We have stored the orginal distance matrix in a file in this
-# example folder.
-
-# Let's parse the observed distance matrix file.
-m_fh = open(os.path.join(examples_dirpath, "target_calpha_distance_matrix.txt"), "r")
-ca_ca_distance_maxtrix = []
-for i, line in enumerate(m_fh):
-    row = [float(v) for v in line.rstrip().split(",")]
-    ca_ca_distance_maxtrix.append(row)
-m_fh.close()
-
-# And add some random errors to off-diagonal elements. We may think of these
-# perturbed distances as the values generated by some accurate distance map
-# prediction program.
-for i, row in enumerate(ca_ca_distance_maxtrix):
-    for j, val in enumerate(row):
-        if i < j:
-            ca_ca_distance_maxtrix[i][j] += random.normalvariate(0, 0.25)
-            ca_ca_distance_maxtrix[j][i] = ca_ca_distance_maxtrix[i][j]
-
-
-#---------------------------------------------------------------------------
-# Step 3/5: obtain the HDDRs list in the MODELLER default restraints file. -
-#---------------------------------------------------------------------------
-
-# In a .rsr file of MODELLER, each HDDR line is defined by the two atoms on which the
-# HDDR is acting (the atoms are specified by their serial numbers in the PDB file of
-# the model created by MODELLER). The 'Automodel_custom_restraints' class of altMOD
-# will look up for each HDDR in the default .rsr file produced by MODELLER, and
-# every time it finds one, it will search in our HDDR parameters file (which is a
-# .csv file) for a row specified by the same atoms. If it finds such a row, it will
-# edit the HDDR line in the MODELLER .rsr file inserting the custom parameters.
-# In our example, we would like to edit all the CA-CA HDDRs produced by MODELLER.
-# MODELLER writes its .rsr file when we call the 'make' method of the 'automodel'
-# class, which will also actually build the final 3D models. How do we know which
-# CA-CA HDDRs MODELLER will use for our model without having to actually carry out
-# the 3D model building phase (and wait for it to complete)?
-# The 'Automodel_custom_restraints' class has a method called 'build_initial_files'
-# which will make MODELLER anticipate the writing of its .rsr file and the .ini
-# PDB file (which contains the model in its initial non-optimized conformation).
-# This method also parses these two files so that we can get information about the
-# HDDRs that MODELLER intends to use before actually building the model.
-
-# Let's first initialze an "automodel" object with the custom class.
-a = Automodel_custom_restraints(env, alnfile=os.path.join(examples_dirpath, 'model_1_st.pir'),
-                                knowns=('template_0',), sequence='model_1_st')
-
-# And then let's call the method. It will write the .rsr and .ini files and parse
-# them.
-a.build_initial_files()
-
-# Now, our "automodel" object has an attribute called the 'hddr_dict', which
-# contains information on all the HDDR written in the MODELLER .rsr file.
-# It is a dictionary, where each key is the MODELLER code for an HDDR group
-# ("9" is the code for CA-CA HDDRs). The values are lists of tuples, where each
-# tuple contains the serial numbers of the atoms engaged in a HDDR.
-print("\n################################")
-print("# MODELLER .rsr file contents. #")
-print("################################\n")
-print("\n# There are %s CA-CA HDDRs used for this model." % len(a.hddr_dict["9"]))
-
-# Let's take a look at some CA-CA HDDRs.
-for i in range(0, 1000, 100):
-
-    # We get the serial numbers of the atoms engaged in a HDDR.
-    atm_num_i, atm_num_j = a.hddr_dict["9"][i]
-    print("\n- CA-CA HDDR %s is acting on atoms: %s and %s." % (i, atm_num_i, atm_num_j))
-
-    # Any atom serial number of our model can now be associated to its corresponding
-    # residue number by using the 'atm_to_res_dict' dictionary (which maps an atom
-    # serial number to the number of its corresponding residue in the PDB).
-    res_num_i = a.atm_to_res_dict[atm_num_i]
-    res_num_j = a.atm_to_res_dict[atm_num_j]
-    print("- These two atoms belong to residues: %s and %s." % (res_num_i, res_num_j))
-
-print("\n")
-
-
-#-----------------------------------------------
-# Step 4/5: write the "HDDR parameters" files. -
-#-----------------------------------------------
-
-# We will create a list of dictionaries to store our custom HDDRs parameters (where
-# each dictionary represents a row of the HDDR parameters file).
-hddr_params_list = []
-
-# Let's iterate through all the CA-CA HDDRs present in the MODELLER restraints file
-# that we intend to modify.
-for atm_1, atm_2 in a.hddr_dict["9"]:
-
-    # From the atoms serial numbers we get the corresponding residue numbers.
-    res_num_1 = a.atm_to_res_dict[atm_1]
-    res_num_2 = a.atm_to_res_dict[atm_2]
-
-    # Now we obtain from our data matrices the new parameters for the CA-CA HDDRs.
+# Paths of the files used in this tutorial, and the templates and target of the
+# model we will build.
+examples_dirpath = os.path.dirname(os.path.abspath(__file__))
+alnfile = os.path.join(examples_dirpath, 'model_1_st.pir')
+knowns = ('template_0',)
+sequence = 'model_1_st'
+
+
+def get_environ():
+    """
+    Initializes the MODELLER environment.
+    """
+    log.none()
+    env = environ()
+    env.io.atom_files_directory = [".", examples_dirpath]
+    return env
+
+
+def build_model(job):
+    """
+    Builds a model using a set of custom HDDR options (see Step 5 below). The
+    files of MODELLER are written in the directory of the job. Each model is
+    built by a new "automodel" object, so that this function can also be used
+    in other processes.
+    """
+    job_dirpath, hddr_options = job
+    if not os.path.isdir(job_dirpath):
+        os.mkdir(job_dirpath)
+    os.chdir(job_dirpath)
+    a = Automodel_custom_restraints(get_environ(), alnfile=alnfile, knowns=knowns, sequence=sequence)
+    a.set_custom_hddr_options(**hddr_options)
+    a.starting_model = 1
+    a.ending_model = 1
+    a.make()
+
+
+# All the steps of this tutorial run inside the block below, so that they are not
+# executed again by the processes which import this script when building several
+# models in parallel (see Step 5).
+if __name__ == "__main__":
+
+    # Initialize the MODELLER environment.
+    env = get_environ()
+
+
+    #----------------------------------------
+    # Step 1/5: obtain custom sigma values. -
+    #----------------------------------------
+
+    # We will start by deriving our sigma values. In MODELLER, by default, sigma
+    # values are assigned by the "histogram-based" algorithm of the program [1].
+    # To serve as an illustratory purpose, here we will generate new sigma values
+    # randomly, but you can use the methods presented in this tutorial to build your
+    # own HDDR parameters file with sigma values originating from any algorithm
+    # (for example, our group is currently working to develop a machine learning
+    # system to estimate optimal sigma values).
+
+    # We will be modeling a target protein (UniProtKB: P56406) with one template.
+    # Our target has 132 residues. Let's generate an array of 132 random numbers which
+    # will serve as a base to build the custom sigma values. For example, these numbers
+    # might be some scores that express some kind of "target-template" expected
+    # structural divergence that we extract from an external algorithm.
+
+    # Generate 132 random floats ranging from 0.05 to 1.0. We draw all of them at
+    # once with a NumPy random number generator (which we will also use later in
+    # this tutorial). The generator is initialized from a seed sequence, which we
+    # keep in order to derive more independent generators from it (see Step 2).
+    target_seq = "TVTVTYDPSNAPSFQQEIANAAQIWNSSVRNVQLRAGGNADFSYYEGNDSRGSYAQTDGHGRGYIFLDYQQNQQYDSTRVTAHETGHVLGLPDHYQGPCSELMSGGGPGPSCTNPYPNAQERSRVNALWANG"
+    seed_seq = np.random.SeedSequence()
+    rng = np.random.default_rng(seed_seq)
+    residue_scores = rng.uniform(0.05, 1.0, size=len(target_seq))
+
+    # Our array is 1d, but sigma values are parameters for distance restraints acting
+    # between pair of atoms: each distance in an model could potentially have
+    # its own sigma value.
+    # In this tutorial we will generate the sigma values only for CA-CA (Carbon alpha)
+    # distances. Therefore we need a 132x132 matrix in which each element could
+    # be used a sigma value for a distance restraint between two CA.
+
+    # In this matrix, each element ij will be just the mean of the values of i and j
+    # in the initial 1d array. Since our scores are stored in a NumPy array, we can
+    # build the whole matrix at once through broadcasting (without any Python loop).
+    sigma_values_matrix = 0.5*(residue_scores[:, None]+residue_scores[None, :])
+
+
+    #-------------------------------------------
+    # Step 2/5: obtain custom location values. -
+    #-------------------------------------------
+
+    # Next we need location parameters for the HDDRs of our model. When performing
+    # single-template modeling, providing custom location parameters is optional, but
+    # to provide an example, we will see how it can be done. As a reminder, in MODELLER,
+    # the location of an HDDR is by default the distance observed in our template.
+    # As a source of custom location parameters, we will use the distances observed
+    # in our target experimentally-determined structure (PDB ID: 1C7K chain A), perturbed
+    # with a small error. We have stored the orginal distance matrix in a file in this
+    # example folder.
+
+    # Let's parse the observed distance matrix file (a comma-separated text file)
+    # directly into a NumPy array. The first time we run this tutorial, we also save
+    # the array in a binary .npy file in the working directory, so that in the next
+    # runs we can load it directly without parsing the text file again.
+    distance_matrix_txt_filepath = os.path.join(examples_dirpath, "target_calpha_distance_matrix.txt")
+    distance_matrix_npy_filepath = "target_calpha_distance_matrix.npy"
+    if os.path.isfile(distance_matrix_npy_filepath) and \
+       os.path.getmtime(distance_matrix_npy_filepath) >= os.path.getmtime(distance_matrix_txt_filepath):
+        ca_ca_distance_maxtrix = np.load(distance_matrix_npy_filepath)
+    else:
+        ca_ca_distance_maxtrix = np.loadtxt(distance_matrix_txt_filepath, delimiter=",", dtype=np.float64)
+        np.save(distance_matrix_npy_filepath, ca_ca_distance_maxtrix)
+
+    # And add some random errors to off-diagonal elements. We may think of these
+    # perturbed distances as the values generated by some accurate distance map
+    # prediction program. We draw all the errors at once and keep only the ones in
+    # the upper triangle (above the diagonal): adding them to the matrix together
+    # with their transpose keeps the matrix symmetric.
+    # Our matrix is small, so a single call to the random number generator is enough.
+    # For very large matrices (for example, if you adapt this tutorial to much larger
+    # proteins or complexes), the errors are drawn in parallel: each thread fills a
+    # block of rows of the matrix with an independent generator initialized from a
+    # seed sequence spawned from ours (NumPy releases the GIL while drawing the
+    # numbers).
+    def fill_noise_rows(child_rng, rows):
+        child_rng.standard_normal(out=rows)
+        rows *= 0.25
+
+    parallel_noise_min_size = 2000
+    n_res = ca_ca_distance_maxtrix.shape[0]
+    if n_res < parallel_noise_min_size:
+        noise = rng.normal(0.0, 0.25, size=ca_ca_distance_maxtrix.shape)
+    else:
+        noise = np.empty(ca_ca_distance_maxtrix.shape)
+        n_threads = min(os.cpu_count() or 1, n_res)
+        rows_bounds = np.linspace(0, n_res, n_threads+1).astype(int)
+        with ThreadPoolExecutor(n_threads) as executor:
+            child_rngs = [np.random.default_rng(child_seq) for child_seq in seed_seq.spawn(n_threads)]
+            list(executor.map(fill_noise_rows, child_rngs,
+                              [noise[start:end] for start, end in zip(rows_bounds[:-1], rows_bounds[1:])]))
+    noise = np.triu(noise, k=1)
+    ca_ca_distance_maxtrix += noise + noise.T
+
+
+    #---------------------------------------------------------------------------
+    # Step 3/5: obtain the HDDRs list in the MODELLER default restraints file. -
+    #---------------------------------------------------------------------------
+
+    # In a .rsr file of MODELLER, each HDDR line is defined by the two atoms on which the
+    # HDDR is acting (the atoms are specified by their serial numbers in the PDB file of
+    # the model created by MODELLER). The 'Automodel_custom_restraints' class of altMOD
+    # will look up for each HDDR in the default .rsr file produced by MODELLER, and
+    # every time it finds one, it will search in our HDDR parameters file (which is a
+    # .csv file) for a row specified by the same atoms. If it finds such a row, it will
+    # edit the HDDR line in the MODELLER .rsr file inserting the custom parameters.
+    # In our example, we would like to edit all the CA-CA HDDRs produced by MODELLER.
+    # MODELLER writes its .rsr file when we call the 'make' method of the 'automodel'
+    # class, which will also actually build the final 3D models. How do we know which
+    # CA-CA HDDRs MODELLER will use for our model without having to actually carry out
+    # the 3D model building phase (and wait for it to complete)?
+    # The 'Automodel_custom_restraints' class has a method called 'build_initial_files'
+    # which will make MODELLER anticipate the writing of its .rsr file and the .ini
+    # PDB file (which contains the model in its initial non-optimized conformation).
+    # This method also parses these two files so that we can get information about the
+    # HDDRs that MODELLER intends to use before actually building the model.
+
+    # Let's first initialze an "automodel" object with the custom class.
+    a = Automodel_custom_restraints(env, alnfile=alnfile, knowns=knowns, sequence=sequence)
+
+    # And then let's call the method. It will write the .rsr and .ini files and parse
+    # them. Since this requires MODELLER to actually build the restraints of the model,
+    # which may take some time, we store the parsed data in a pickle file in the working
+    # directory and reuse it in the next runs of this tutorial. This is useful when
+    # running the tutorial many times, for example while trying different algorithms
+    # to derive the custom parameters. The data is reused only if the alignment file
+    # and the PDB files of the templates were not modified (we check their modification
+    # times), if the templates and target sequence names are the same, and if the
+    # versions of MODELLER and altMOD did not change.
+    initial_files_cache_filepath = "initial_files_cache.pkl"
+    aln = a.read_alignment()
+    templates_mtimes = []
+    for tem_name in a.knowns:
+        atom_filepaths = [os.path.join(atom_dirpath, aln[tem_name].atom_file)
+                          for atom_dirpath in env.io.atom_files_directory]
+        atom_filepaths = [fp for fp in atom_filepaths if os.path.isfile(fp)]
+        templates_mtimes.append(os.path.getmtime(atom_filepaths[0]) if atom_filepaths else None)
+    initial_files_cache_key = (os.path.getmtime(a.alnfile), tuple(templates_mtimes),
+                               tuple(a.knowns), a.sequence, info.version, altmod.__version__)
+    initial_files_attrs = ("atm_to_res_dict", "atm_type_dict", "res_to_atm_dict",
+                           "restrained_atm_couples", "restrained_res_couples", "hddr_dict")
+    initial_files_data = None
+    if os.path.isfile(initial_files_cache_filepath):
+        with open(initial_files_cache_filepath, "rb") as p_fh:
+            cache_key, cache_data = pickle.load(p_fh)
+        if cache_key == initial_files_cache_key:
+            initial_files_data = cache_data
+
+    if initial_files_data is not None:
+        for attr in initial_files_attrs:
+            setattr(a, attr, initial_files_data[attr])
+    else:
+        a.build_initial_files()
+        initial_files_data = dict([(attr, getattr(a, attr)) for attr in initial_files_attrs])
+        with open(initial_files_cache_filepath, "wb") as p_fh:
+            pickle.dump((initial_files_cache_key, initial_files_data), p_fh)
+
+    # Now, our "automodel" object has an attribute called the 'hddr_dict', which
+    # contains information on all the HDDR written in the MODELLER .rsr file.
+    # It is a dictionary, where each key is the MODELLER code for an HDDR group
+    # ("9" is the code for CA-CA HDDRs). The values are lists of tuples, where each
+    # tuple contains the serial numbers of the atoms engaged in a HDDR.
+    print("\n################################")
+    print("# MODELLER .rsr file contents. #")
+    print("################################\n")
+    print("\n# There are %s CA-CA HDDRs used for this model." % len(a.hddr_dict["9"]))
+
+    # Let's take a look at some CA-CA HDDRs.
+    for i in range(0, 1000, 100):
+
+        # We get the serial numbers of the atoms engaged in a HDDR.
+        atm_num_i, atm_num_j = a.hddr_dict["9"][i]
+        print("\n- CA-CA HDDR %s is acting on atoms: %s and %s." % (i, atm_num_i, atm_num_j))
+
+        # Any atom serial number of our model can now be associated to its corresponding
+        # residue number by using the 'atm_to_res_dict' dictionary (which maps an atom
+        # serial number to the number of its corresponding residue in the PDB).
+        res_num_i = a.atm_to_res_dict[atm_num_i]
+        res_num_j = a.atm_to_res_dict[atm_num_j]
+        print("- These two atoms belong to residues: %s and %s." % (res_num_i, res_num_j))
+
+    print("\n")
+
+
+    #-----------------------------------------------
+    # Step 4/5: write the "HDDR parameters" files. -
+    #-----------------------------------------------
+
+    # We will store our custom HDDRs parameters column by column: each column of the
+    # HDDR parameters file will be a NumPy array, with one element per HDDR.
+    column_names = ["MOD_ATOM_INDEX_I", "MOD_ATOM_INDEX_J", "NEW_SIGMA", "NEW_LOCATION"]
+    # Format used to write the values of each column.
+    column_formats = ["%d", "%d", "%.6g", "%.6g"]
+
+    # Set this to 'True' to also write the template distances of the HDDRs in the
+    # file (see below). We will not use them in this tutorial, so by default we skip
+    # their computation.
+    compute_template_distances = False
+
+    # Instead of iterating through the CA-CA HDDRs present in the MODELLER restraints
+    # file one at a time, we will process all of them at once with NumPy. Let's store
+    # the serial numbers of the atoms engaged in the HDDRs in an array with one row
+    # per HDDR.
+    atoms = np.asarray(a.hddr_dict["9"], dtype=np.int32).reshape(-1, 2)
+
+    # HDDRs are undirected, and 'Automodel_custom_restraints' will look up a pair of
+    # atoms in our HDDR parameters file in both orders. Therefore we only need one row
+    # for each pair, and we can remove any duplicate pair (including pairs with the
+    # same atoms in reversed order). We encode each pair in a single integer key
+    # built from its lower and higher atom serial numbers, and keep the first
+    # occurrence of each key.
+    atm_min = np.minimum(atoms[:, 0], atoms[:, 1]).astype(np.int64)
+    atm_max = np.maximum(atoms[:, 0], atoms[:, 1]).astype(np.int64)
+    pair_keys = atm_min*(int(atoms.max())+1)+atm_max
+    _, unique_idx = np.unique(pair_keys, return_index=True)
+    atoms = atoms[unique_idx]
+
+    # We also sort the HDDRs by the serial numbers of their first and second atoms,
+    # so that the rows of our file will be ordered like the atoms of the model.
+    atoms = atoms[np.lexsort((atoms[:, 1], atoms[:, 0]))]
+
+    # In order to get the residue numbers corresponding to the atoms serial numbers,
+    # we convert the 'atm_to_res_dict' dictionary in an array in which the element
+    # at index i is the residue number of the atom with serial number i. The keys
+    # and values of the dictionary are copied in two arrays, which are then used to
+    # fill the lookup array in a single assignment.
+    atm_nums = np.fromiter(a.atm_to_res_dict.keys(), dtype=np.int64, count=len(a.atm_to_res_dict))
+    res_nums = np.fromiter(a.atm_to_res_dict.values(), dtype=np.int32, count=len(a.atm_to_res_dict))
+    atm_to_res_arr = np.zeros(atm_nums.max()+1, dtype=np.int32)
+    atm_to_res_arr[atm_nums] = res_nums
+
+    # Now we obtain from our data matrices the new parameters for all the CA-CA HDDRs.
     # Note that we can use the residue numbers of the model as indices for our
-    # matrices, because by default in MODELLER residues are numbered from 1.
-    new_sigma = sigma_values_matrix[res_num_1-1][res_num_2-1]
-    new_location = ca_ca_distance_maxtrix[res_num_1-1][res_num_2-1]
+    # matrices, because by default in MODELLER residues are numbered from 1. Since
+    # the two matrices have the same shape, we convert the (i, j) residue indices of
+    # each HDDR into a single flat index only once, and use it to gather the values
+    # from both matrices.
+    res_i = atm_to_res_arr[atoms[:, 0]]-1
+    res_j = atm_to_res_arr[atoms[:, 1]]-1
+    pair_idx = np.ravel_multi_index((res_i, res_j), sigma_values_matrix.shape)
+    new_sigma = sigma_values_matrix.take(pair_idx)
+    new_location = ca_ca_distance_maxtrix.take(pair_idx)
+
+    # We collect the columns of the .csv file, in the same order of 'column_names':
+    # the serial numbers of the atoms on which the HDDR is acting and the new sigma
+    # and location parameters.
+    hddr_params_columns = [atoms[:, 0], atoms[:, 1], new_sigma, new_location]
 
     # As an example, let's also take a look at how to obtain template distances.
     # In this tutorial, we will not be using these distances, but when you write
@@ -185,69 +328,91 @@ for atm_1, atm_2 in a.hddr_dict["9"]:
     # Suppose we have two atom serial numbers of our model, and we would like
     # to know what is the corresponding distance between the equivalent atoms in
     # the template. To do that, we can use the 'get_template_distance' method of
-    # the 'Automodel_custom_restraints' class.
-    template_distance = a.get_template_distance(atm_1, atm_2, template_index=0)
-
-    # We build a dictionary representing a .csv file line.
-    hddr_params = {# Serial numbers of the atoms on which the HDDR is acting.
-                   "MOD_ATOM_INDEX_I": atm_1, "MOD_ATOM_INDEX_J": atm_2,
-                   # New sigma and location parameters.
-                   "NEW_SIGMA": new_sigma, "NEW_LOCATION": new_location,
-                   # Template distance (not actually used to build the new HDDRs now).
-                   "_TEMPLATE_DISTANCE": template_distance
-                   }
-    hddr_params_list.append(hddr_params)
-
-
-# Let's write the HDDR parameters file. Here we are using the 'csv' module of the
-# standard library of Python, but you may build an these files with any method
-# (for example, pandas).
-custom_hddr_params_filepath = "custom_hddr_params.csv"
-c_fh = open(custom_hddr_params_filepath, "w")
-column_names = ["MOD_ATOM_INDEX_I", "MOD_ATOM_INDEX_J", "NEW_SIGMA", "NEW_LOCATION", "_TEMPLATE_DISTANCE"]
-csv_writer = csv.DictWriter(c_fh, fieldnames=column_names)
-csv_writer.writeheader()
-for hddr_params in hddr_params_list:
-    csv_writer.writerow(hddr_params)
-c_fh.close()
-
-
-#-----------------------------------------------------------------
-# Step 5/5: build the 3D models with the custom HDDR parameters. -
-#-----------------------------------------------------------------
-
-# Before actually building the models, we have to use the 'set_custom_hddr_options'
-# method to define options about the HDDR we want to rebuild.
-a.set_custom_hddr_options(# Path of the custom HDDR parameters files.
-                          hddr_params_filepaths=custom_hddr_params_filepath,
-                          # Names of the atom i and j columns.
-                          atom_i_col="MOD_ATOM_INDEX_I",
-                          atom_j_col="MOD_ATOM_INDEX_J",
-                          # Define the name of the custom sigma values column.
-                          sigma_col="NEW_SIGMA",
-                          # Define the name of the custom location values column.
-                          # When performing single-template modeling, this is
-                          # optional, since if whe do not provide one, altMOD will
-                          # use as location parameters the values present in the
-                          # default MODELLER .rsr file.
-                          location_col="NEW_LOCATION",
-                          # By setting as 'True' this argument, those HDDRs in the
-                          # .rsr file which are not found in the HDDR paramaters
-                          # file, will be deleted. In our example, this will remove
-                          # from the .rsr file all the non CA-CA HDDRs (for example
-                          # the side chains ones), because we did not insert custom
-                          # parameters for these HDDRs in our parameters file.
-                          # While CA-CA HDDRs are the most important ones to
-                          # correctly model backbones, removing additional HDDRs
-                          # usually results in poor side chain modeling and bad
-                          # stereochemistry, so use this option carefully.
-                          remove_missing_hddrs=True,
-                          )
-
-# We can finally build the models in the traditional way. The 'Automodel_custom_restraints'
-# class will take care of editing the HDDRs lines in the .rsr file of MODELLER with
-# the parameters you specified in the HDDR parameters files. In this way, MODELLER
-# will build the model using our custom parameters for its CA-CA HDDRs.
-a.starting_model = 1
-a.ending_model = 1
-a.make()
+    # the 'Automodel_custom_restraints' class. Since here we have a lot of atom pairs,
+    # we use its batch version, the 'get_template_distances' method, which computes
+    # the template distances of all the pairs at once (pairs with some atom without
+    # an equivalent atom in the template will get a 'nan' value).
+    if compute_template_distances:
+        template_distances = a.get_template_distances(atoms[:, 0], atoms[:, 1], template_index=0)
+        # Add the template distances as an additional column (not actually used to
+        # build the new HDDRs now).
+        column_names.append("_TEMPLATE_DISTANCE")
+        column_formats.append("%.6g")
+        hddr_params_columns.append(template_distances)
+
+
+    # Let's write the HDDR parameters file. Since our columns are already stored in
+    # NumPy arrays, here we stack them in a 2d array and write it with the 'savetxt'
+    # function of NumPy, which formats each line using a single format string built
+    # from the formats of the columns. You may build these files with any method (for
+    # example, with the 'csv' module of the standard library of Python or pandas), as
+    # long as they are .csv files with a header line.
+    custom_hddr_params_filepath = os.path.abspath("custom_hddr_params.csv")
+    c_fh = open(custom_hddr_params_filepath, "w", newline="", buffering=1<<20)
+    np.savetxt(c_fh, np.column_stack(hddr_params_columns), fmt=",".join(column_formats),
+               header=",".join(column_names), comments="")
+    c_fh.close()
+
+
+    #-----------------------------------------------------------------
+    # Step 5/5: build the 3D models with the custom HDDR parameters. -
+    #-----------------------------------------------------------------
+
+    # Before actually building the models, we have to use the 'set_custom_hddr_options'
+    # method to define options about the HDDR we want to rebuild. Let's store these
+    # options in a dictionary (its keys are the arguments of the method).
+    custom_hddr_options = dict(# Paths of the custom HDDR parameters files (one per
+                               # template).
+                               hddr_params_filepaths=[custom_hddr_params_filepath],
+                               # Names of the atom i and j columns.
+                               atom_i_col="MOD_ATOM_INDEX_I",
+                               atom_j_col="MOD_ATOM_INDEX_J",
+                               # Define the name of the custom sigma values column.
+                               sigma_col="NEW_SIGMA",
+                               # Define the name of the custom location values column.
+                               # When performing single-template modeling, this is
+                               # optional, since if whe do not provide one, altMOD will
+                               # use as location parameters the values present in the
+                               # default MODELLER .rsr file.
+                               location_col="NEW_LOCATION",
+                               # By setting as 'True' this argument, those HDDRs in the
+                               # .rsr file which are not found in the HDDR paramaters
+                               # file, will be deleted. In our example, this will remove
+                               # from the .rsr file all the non CA-CA HDDRs (for example
+                               # the side chains ones), because we did not insert custom
+                               # parameters for these HDDRs in our parameters file.
+                               # While CA-CA HDDRs are the most important ones to
+                               # correctly model backbones, removing additional HDDRs
+                               # usually results in poor side chain modeling and bad
+                               # stereochemistry, so use this option carefully.
+                               remove_missing_hddrs=True,
+                               )
+
+    # When tuning custom parameters, you may want to compare models built with several
+    # HDDR parameters files or options. Here we build only one model, with the options
+    # defined above, but you can add more dictionaries to this list (for example, a
+    # copy of the one above with 'remove_missing_hddrs' set to 'False').
+    custom_hddr_options_list = [custom_hddr_options]
+
+    # We can finally build the models in the traditional way, by using the 'build_model'
+    # function defined at the beginning of this script. The 'Automodel_custom_restraints'
+    # class will take care of editing the HDDRs lines in the .rsr file of MODELLER with
+    # the parameters you specified in the HDDR parameters files. In this way, MODELLER
+    # will build the model using our custom parameters for its CA-CA HDDRs.
+    # With a single set of options, we just build the model in the working directory.
+    # With more sets, each model is independent from the others, so we build them in
+    # parallel, one per process. Each model is built in its own subdirectory, since
+    # MODELLER writes files with the same names for all of them. The processes are
+    # started from scratch (they are not forked from this one), and each of them
+    # builds only one model.
+    if len(custom_hddr_options_list) == 1:
+        build_model((".", custom_hddr_options_list[0]))
+    else:
+        jobs = [(os.path.abspath("model_%s" % (i+1)), hddr_options) for i, hddr_options in enumerate(custom_hddr_options_list)]
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            mp_context = multiprocessing.get_context("forkserver")
+        else:
+            mp_context = multiprocessing.get_context("spawn")
+        n_processes = min(len(jobs), os.cpu_count() or 1)
+        with mp_context.Pool(n_processes, maxtasksperchild=1) as pool:
+            pool.map(build_model, jobs)
@@ -23,45 +23,54 @@ from modeller.automodel import automodel
 from altmod.automodel_optimal_restraints import Automodel_optimal_restraints
 
 
-# Initialize the MODELLER environment.
-script_dirpath = os.path.dirname(os.path.dirname(__file__))
-examples_dirpath = os.path.join(os.path.join(script_dirpath, "basic_example"))
-log.none()
-env = environ()
-env.io.atom_files_directory = [".", examples_dirpath]
+# All the code of this tutorial runs inside the block below, so that it is not
+# executed again by child processes which import this script (for example when
+# using more than one process in the 'set_target_structure' method on platforms
+# where processes are spawned).
+if __name__ == "__main__":
 
+    # Initialize the MODELLER environment.
+    script_dirpath = os.path.dirname(os.path.dirname(__file__))
+    examples_dirpath = os.path.join(os.path.join(script_dirpath, "basic_example"))
+    log.none()
+    env = environ()
+    env.io.atom_files_directory = [".", examples_dirpath]
 
-# As a first thing, we initialize an automodel object like we usually do in
-# MODELLER, except that we will use the 'Automodel_optimal_restraints' class
-# imported from the 'altmod' package. Here, we will be modeling a target protein
-# (UniProtKB: O96445) with three templates. It's the same protein used in the
-# original MODELLER tutorial (https://salilab.org/modeller/tutorial/basic.html).
-a = Automodel_optimal_restraints(env,
-                                 alnfile=os.path.join(examples_dirpath, 'tar_tem_mt_alignment.ali'),
-                                 knowns=('1bdmA', "2mdhA", "1b8pA"),
-                                 sequence='TvLDH')
 
-# Luckily, since an experimentally-determined structure of this protein is available
-# (PDB code: 4UUM) we can readily extract the theoretically optimal parameters for
-# the HDDRs which MODELLER will use to model this target.
-# Let's use the 'set_target_structure' to define the path of the target structure.
-# Note that since the PDB file of the target has more than one chain, we have
-# to specify through the 'target_chain' argument which chain corresponds to our
-# target protein.
-a.set_target_structure(target_filepath=os.path.join(examples_dirpath, '4uum.pdb'), target_chain="A",)
+    # As a first thing, we initialize an automodel object like we usually do in
+    # MODELLER, except that we will use the 'Automodel_optimal_restraints' class
+    # imported from the 'altmod' package. Here, we will be modeling a target protein
+    # (UniProtKB: O96445) with three templates. It's the same protein used in the
+    # original MODELLER tutorial (https://salilab.org/modeller/tutorial/basic.html).
+    a = Automodel_optimal_restraints(env,
+                                     alnfile=os.path.join(examples_dirpath, 'tar_tem_mt_alignment.ali'),
+                                     knowns=('1bdmA', "2mdhA", "1b8pA"),
+                                     sequence='TvLDH')
 
-# We can finally build the models in the traditional way. The 'Automodel_optimal_restraints'
-# class will take care of editing the HDDRs lines in the .rsr file of MODELLER with
-# the optimal parameters calculated by analysing the structural divergence in each
-# restrained distance in each target-template pair.
-a.starting_model = 1
-a.ending_model = 1
-a.make()
+    # Luckily, since an experimentally-determined structure of this protein is available
+    # (PDB code: 4UUM) we can readily extract the theoretically optimal parameters for
+    # the HDDRs which MODELLER will use to model this target.
+    # Let's use the 'set_target_structure' to define the path of the target structure.
+    # Note that since the PDB file of the target has more than one chain, we have
+    # to specify through the 'target_chain' argument which chain corresponds to our
+    # target protein.
+    # The three target-template pairs are analysed independently, so we could also
+    # analyse them in parallel, one per process, by setting the 'n_jobs' argument
+    # of this method (by default, they are analysed one after the other).
+    a.set_target_structure(target_filepath=os.path.join(examples_dirpath, '4uum.pdb'), target_chain="A",)
 
-# If you take the model built in this way and measure its RMSD with the target
-# structure, you will notice a very low value (we get 0.350 A using PyMOL's cealign).
-# If your run this script again by using the default 'automodel' class from
-# MODELLER and measure the RMSD of the model built with default HDDR parameters,
-# you will notice a much higher value (we get 1.458 A).
-# Being able to accurately infer near-optimal HDDR parameters would make an
-# important difference when applying the MODELLER strategy for homology modeling!
+    # We can finally build the models in the traditional way. The 'Automodel_optimal_restraints'
+    # class will take care of editing the HDDRs lines in the .rsr file of MODELLER with
+    # the optimal parameters calculated by analysing the structural divergence in each
+    # restrained distance in each target-template pair.
+    a.starting_model = 1
+    a.ending_model = 1
+    a.make()
+
+    # If you take the model built in this way and measure its RMSD with the target
+    # structure, you will notice a very low value (we get 0.350 A using PyMOL's cealign).
+    # If your run this script again by using the default 'automodel' class from
+    # MODELLER and measure the RMSD of the model built with default HDDR parameters,
+    # you will notice a much higher value (we get 1.458 A).
+    # Being able to accurately infer near-optimal HDDR parameters would make an
+    # important difference when applying the MODELLER strategy for homology modeling!